@@ -1,14 +1,64 @@
-import matplotlib
-matplotlib.use("Agg")
-
 from lxml import etree
-from matplotlib import pyplot as plt
 import argparse
-import base64
-import struct
+try:
+    import pybase64 as base64  # SIMD-accelerated, drop-in for the stdlib module
+except ImportError:
+    import base64
+import os
 import numpy as np
 import glob
 from pathlib import Path
+from functools import lru_cache
+
+# One parser, reused for every file (building a new XMLParser per call is wasted work in batch runs)
+_PARSER = etree.XMLParser(collect_ids=False, huge_tree=False, remove_blank_text=True)
+
+# Compiled once; element.xpath('...') would recompile the expression on every call
+_DIAG_XPATH = etree.XPath('./Diagnosis/DiagnosisStatement')
+_ORIG_DIAG_XPATH = etree.XPath('./OriginalDiagnosis/DiagnosisStatement')
+_WAVEFORM_XPATH = etree.XPath('.//Waveform')
+_LEADDATA_XPATH = etree.XPath('.//LeadData')
+
+_MEASUREMENTS = ('VentricularRate', 'AtrialRate', 'PRInterval', 'QRSDuration', 'QTInterval',
+                 'QTCorrected', 'PAxis', 'RAxis', 'TAxis', 'QRSCount')
+
+# (section, tag) -> ECG key for every value read from the top-level sections,
+# so extract_xml can fill all of them in one pass instead of one findtext each
+_FIELD_PATHS = {
+    ('PatientDemographics', 'PatientID'): 'patient_id',
+    **{('RestingECGMeasurements', m): m for m in _MEASUREMENTS},
+}
+
+
+def _i16_to_f32_scaled(raw, out, scale):
+    # Little-endian int16 -> scaled float32 in one sweep, no int16 temporary.
+    # Plain Python here; _get_i16_kernel() jit-compiles it with numba.
+    for i in range(out.size):
+        v = raw[2 * i] | (raw[2 * i + 1] << 8)
+        if v & 0x8000:
+            v -= 0x10000
+        out[i] = v * scale
+
+
+# None until first use; False once we know numba isn't installed
+_I16_KERNEL = None
+
+
+def _get_i16_kernel():
+    """
+    Return the numba-compiled _i16_to_f32_scaled, or None without numba.
+    numba is imported on the first call only, so importing this module
+    stays cheap for callers that never decode waveforms.
+    """
+    global _I16_KERNEL
+    if _I16_KERNEL is None:
+        try:
+            import numba
+        except ImportError:
+            _I16_KERNEL = False
+        else:
+            _I16_KERNEL = numba.njit(cache=True, fastmath=True, boundscheck=False)(_i16_to_f32_scaled)
+    return _I16_KERNEL or None
 
 
 def decode_waveform(b64_data, scale=4.88):
@@ -18,89 +68,106 @@ def decode_waveform(b64_data, scale=4.88):
     - b64_data: Base64-encoded string of waveform data.
     - scale: Scaling factor to convert raw data to microvolts.
     Outputs:
-    - Numpy array of decoded waveform samples in microvolts.
+    - Numpy array (float32) of decoded waveform samples in microvolts.
+    Uses a numba kernel when numba is installed, plain numpy otherwise.
+    Raises ValueError if b64_data is not valid base64.
     """
 
-    try:
-        # Decode base64 to binary
-        binary_data = base64.b64decode(b64_data)
-        num_samples = len(binary_data) // 2
+    # Strip line breaks/whitespace once so the decoder sees contiguous base64
+    b64_bytes = b64_data.encode('ascii').translate(None, b' \t\r\n')
 
-        # Unpack little-endian signed 16-bit integers
-        samples = struct.unpack('<' + 'h' * num_samples, binary_data[:num_samples*2])
+    # Decode base64 to binary
+    binary_data = base64.b64decode(b64_bytes, validate=False)
+    num_samples = len(binary_data) // 2
 
-        # Scale to microvolts
-        return np.array(samples) * scale
-    except Exception as e:
-        return f"[Error decoding waveform: {e}]"
+    kernel = _get_i16_kernel()
+    if kernel is not None:
+        # Fused decode + scale to microvolts (numba)
+        samples = np.empty(num_samples, dtype=np.float32)
+        kernel(np.frombuffer(binary_data, dtype=np.uint8), samples, np.float32(scale))
+        return samples
 
+    # View as little-endian signed 16-bit integers (no per-sample Python ints)
+    samples = np.frombuffer(binary_data, dtype='<i2', count=num_samples)
 
-def extract_xml(filename):
-    """
-    Extract relevant ECG data from a Muse XML file.
+    # Scale to microvolts
+    samples = samples.astype(np.float32)
+    samples *= np.float32(scale)
+    return samples
 
-    Returns a dictionary with ECG data and metadata.
+
+def join_diagnosis_statements(statements):
+    """
+    Join DiagnosisStatement elements into a single diagnosis string.
+    Statements are separated by a space; a newline follows each ENDSLINE flag.
 
     Inputs:
-    - filename: Path to the Muse XML file.
+    - statements: Iterable of DiagnosisStatement elements.
 
     Outputs:
-    - ECG: Dictionary containing ECG data and metadata.
+    - Joined diagnosis text (unstripped).
     """
-    def get_int_or_none(path):
-        val = root.findtext(path)
+    # Collect pieces and join once; += on a str copies the whole string each time
+    parts = []
+    for diag_statement in statements:
+        # One scan over the children instead of a find() per tag
+        text = None
+        ends_line = False
+        for child in diag_statement:
+            if child.tag == 'StmtText':
+                if text is None:
+                    text = child.text
+            elif child.tag == 'StmtFlag' and child.text and child.text.strip() == 'ENDSLINE':
+                ends_line = True
+        if text:
+            parts.append(text.strip())
+            parts.append(' ')
+        if ends_line:
+            parts.append('\n')
+    return ''.join(parts)
+
+
+def _extract_xml_impl(filename):
+    """
+    Parse a Muse XML file into the ECG dictionary (uncached; see extract_xml).
+    Holds only immutable values so the result is safe to cache.
+    """
+    def get_int_or_none(key):
+        val = fields.get(key)
         return int(val) if val is not None and val.strip().isdigit() else None
 
-    parser = etree.XMLParser()
-    tree = etree.parse(filename, parser)
-    root = tree.getroot()
+    # Hand libxml2 the whole file as one buffer instead of going through its file I/O
+    with open(filename, 'rb') as f:
+        root = etree.fromstring(f.read(), _PARSER, base_url=str(filename))
+
+    # One pass over the top-level sections; first match wins, like findtext
+    fields = {}
+    for section in root:
+        for elem in section:
+            key = _FIELD_PATHS.get((section.tag, elem.tag))
+            if key is not None and key not in fields:
+                fields[key] = elem.text or ''
 
     ECG = {
         'file_path': filename,
-        'patient_id': root.findtext('.//PatientID', default='Unknown'),
+        'patient_id': fields.get('patient_id', 'Unknown'),
         'diagnosis_statement': '',
         'original_diagnosis': '',
-        'leads': {
-            'I': np.array([]),
-            'II': np.array([]),
-            'V1': np.array([]),
-            'V2': np.array([]),
-            'V3': np.array([]),
-            'V4': np.array([]),
-            'V5': np.array([]),
-            'V6': np.array([]),
-        },
-        'VentricularRate': get_int_or_none('./RestingECGMeasurements/VentricularRate'),
-        'AtrialRate': get_int_or_none('./RestingECGMeasurements/AtrialRate'),
-        'PRInterval': get_int_or_none('./RestingECGMeasurements/PRInterval'),
-        'QRSDuration': get_int_or_none('./RestingECGMeasurements/QRSDuration'),
-        'QTInterval': get_int_or_none('./RestingECGMeasurements/QTInterval'),
-        'QTCorrected': get_int_or_none('./RestingECGMeasurements/QTCorrected'),
-        'PAxis': get_int_or_none('./RestingECGMeasurements/PAxis'),
-        'RAxis': get_int_or_none('./RestingECGMeasurements/RAxis'),
-        'TAxis': get_int_or_none('./RestingECGMeasurements/TAxis'),
-        'QRSCount': get_int_or_none('./RestingECGMeasurements/QRSCount'),
+        'VentricularRate': get_int_or_none('VentricularRate'),
+        'AtrialRate': get_int_or_none('AtrialRate'),
+        'PRInterval': get_int_or_none('PRInterval'),
+        'QRSDuration': get_int_or_none('QRSDuration'),
+        'QTInterval': get_int_or_none('QTInterval'),
+        'QTCorrected': get_int_or_none('QTCorrected'),
+        'PAxis': get_int_or_none('PAxis'),
+        'RAxis': get_int_or_none('RAxis'),
+        'TAxis': get_int_or_none('TAxis'),
+        'QRSCount': get_int_or_none('QRSCount'),
 
     }
 
-    for diag_statment in root.xpath('./Diagnosis/DiagnosisStatement'):
-        if diag_statment.tag.lower() == 'diagnosisstatement':
-            ECG['diagnosis_statement'] += diag_statment.find('StmtText').text.strip() + ' '
-            try:
-                if diag_statment.find('StmtFlag').text.strip() == 'ENDSLINE':
-                    ECG['diagnosis_statement'] += '\n'
-            except AttributeError:
-                pass
-
-    for diag_statement in root.xpath('./OriginalDiagnosis/DiagnosisStatement'):
-        if diag_statement.tag.lower() == 'diagnosisstatement':
-            ECG['original_diagnosis'] += diag_statement.find('StmtText').text.strip() + ' '
-            try:
-                if diag_statement.find('StmtFlag').text.strip() == 'ENDSLINE':
-                    ECG['original_diagnosis'] += '\n'
-            except AttributeError:
-                pass
-
+    ECG['diagnosis_statement'] = join_diagnosis_statements(_DIAG_XPATH(root))
+    ECG['original_diagnosis'] = join_diagnosis_statements(_ORIG_DIAG_XPATH(root))
 
     ECG['diagnosis_statement'] = ECG['diagnosis_statement'].strip() if ECG['diagnosis_statement'] else None
     ECG['original_diagnosis'] = ECG['original_diagnosis'].strip() if ECG['original_diagnosis'] else None
@@ -108,6 +175,43 @@ def extract_xml(filename):
     return ECG
 
 
+@lru_cache(maxsize=2048)
+def _extract_xml_cached(filename, mtime_ns, size):
+    # mtime_ns/size only feed the cache key
+    return _extract_xml_impl(filename)
+
+
+def extract_xml(filename):
+    """
+    Extract relevant ECG data from a Muse XML file.
+
+    Returns a dictionary with ECG data and metadata.
+    Results are cached per (path, mtime, size), so re-reading an unchanged
+    file skips the parse; editing the file invalidates its entry.
+
+    Inputs:
+    - filename: Path to the Muse XML file.
+
+    Outputs:
+    - ECG: Dictionary containing ECG data and metadata.
+    """
+    st = os.stat(filename)
+    # Copy the cached scalars; the leads placeholder is built fresh on every call
+    # (callers fill it in, so it must never be shared through the cache)
+    ECG = dict(_extract_xml_cached(filename, st.st_mtime_ns, st.st_size))
+    ECG['leads'] = {
+        'I': np.array([]),
+        'II': np.array([]),
+        'V1': np.array([]),
+        'V2': np.array([]),
+        'V3': np.array([]),
+        'V4': np.array([]),
+        'V5': np.array([]),
+        'V6': np.array([]),
+    }
+    return ECG
+
+
 def get_lead_data(filename):
     """
     Extract lead waveform data from a Muse XML file.
@@ -119,9 +223,9 @@ def get_lead_data(filename):
     - leads: Dictionary with lead names as keys and numpy arrays of waveform data as values.
     """
 
-    parser = etree.XMLParser()
-    tree = etree.parse(filename, parser)
-    root = tree.getroot()
+    # Hand libxml2 the whole file as one buffer instead of going through its file I/O
+    with open(filename, 'rb') as f:
+        root = etree.fromstring(f.read(), _PARSER, base_url=str(filename))
     leads = {
         'I': np.array([]),
         'II': np.array([]),
@@ -136,13 +240,13 @@ def get_lead_data(filename):
         'V5': np.array([]),
         'V6': np.array([]),
     }
-    for waveform in root.xpath('.//Waveform'):
+    for waveform in _WAVEFORM_XPATH(root):
         waveform_type = waveform.find('WaveformType').text.lower()
         if waveform_type != 'rhythm':
             continue
         pass
 
-        for lead_data in waveform.xpath('.//LeadData'): # Waveform to get median or whatever
+        for lead_data in _LEADDATA_XPATH(waveform): # Waveform to get median or whatever
             lead_id_elem = lead_data.find('LeadID')
             waveform_elem = lead_data.find('WaveFormData')
 
@@ -153,17 +257,29 @@ def get_lead_data(filename):
                 # print(f"\n--- Lead: {lead_id} ---")
                 scale_elem = lead_data.find('LeadAmplitudeUnitsPerBit')
                 scale = float(scale_elem.text.strip()) if scale_elem is not None else 1.0
-                decoded = decode_waveform(waveform_text, scale=scale)
+                try:
+                    decoded = decode_waveform(waveform_text, scale=scale)
+                except ValueError as e:
+                    print(f"[WARN] Could not decode lead {lead_id}: {e}")
+                    continue
                 # print(f"Decoded {len(decoded)} samples:")
-                leads[lead_id] = np.array(decoded)
+                leads[lead_id] = decoded
                 # print(decoded[:20], "... (first 20 samples)")
             else:
                 print("No waveform data found.")
 
-    leads["III"] = leads["II"] - leads["I"]
-    leads["aVR"] = -(leads["I"] + leads["II"]) / 2
-    leads["aVL"] = leads["I"] - leads["II"] / 2
-    leads["aVF"] = leads["II"] - leads["I"] / 2
+    # Derived limb leads: one float32 allocation each, the rest done in place
+    lead_I, lead_II = leads["I"], leads["II"]
+    leads["III"] = np.subtract(lead_II, lead_I, dtype=np.float32)
+
+    leads["aVR"] = np.add(lead_I, lead_II, dtype=np.float32)
+    leads["aVR"] *= np.float32(-0.5)
+
+    leads["aVL"] = np.multiply(lead_II, np.float32(-0.5), dtype=np.float32)
+    leads["aVL"] += lead_I
+
+    leads["aVF"] = np.multiply(lead_I, np.float32(-0.5), dtype=np.float32)
+    leads["aVF"] += lead_II
 
     return leads
 
@@ -179,6 +295,11 @@ def plot_ecgs(filename):
     - None (displays plots).
     """
 
+    # Imported here so extract_xml users don't pay matplotlib's startup cost
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot as plt
+
     ecg = get_lead_data(filename)
     leads = ["aVF", "V2", "V5"]
     num_leads = len(leads)
@@ -1,94 +1,161 @@
 
 from lxml import etree
 import argparse
-import csv
-import struct
+import os
 import numpy as np
 import glob
 from pathlib import Path
-
-def extract_xml(filename):
+from functools import lru_cache
+import multiprocessing as mp
+
+# One parser, reused for every file (building a new XMLParser per call is wasted work in batch runs)
+_PARSER = etree.XMLParser(collect_ids=False, huge_tree=False, remove_blank_text=True)
+
+# Compiled once; element.xpath('...') would recompile the expression on every call
+_DIAG_XPATH = etree.XPath('./Diagnosis/DiagnosisStatement')
+_ORIG_DIAG_XPATH = etree.XPath('./OriginalDiagnosis/DiagnosisStatement')
+
+_MEASUREMENTS = ('VentricularRate', 'AtrialRate', 'PRInterval', 'QRSDuration', 'QTInterval',
+                 'QTCorrected', 'PAxis', 'RAxis', 'TAxis', 'QRSCount')
+
+# (section, tag) -> ECG key for every value read from the top-level sections,
+# so extract_xml can fill all of them in one pass instead of one findtext each
+_FIELD_PATHS = {
+    ('PatientDemographics', 'PatientID'): 'patient_id',
+    ('PatientDemographics', 'PatientAge'): 'patient_age',
+    ('PatientDemographics', 'Gender'): 'patient_gender',
+    ('PatientDemographics', 'Race'): 'patient_race',
+    ('TestDemographics', 'Priority'): 'priority',
+    ('TestDemographics', 'LocationName'): 'location',
+    ('TestDemographics', 'AcquisitionDate'): 'ecg_date',
+    ('TestDemographics', 'AcquisitionSoftwareVersion'): 'acquisition_software_version',
+    ('TestDemographics', 'AnalysisSoftwareVersion'): 'analysis_software_version',
+    ('TestDemographics', 'OverreaderLastName'): 'overread_lastname',
+    ('TestDemographics', 'OverreaderFirstName'): 'overread_firstname',
+    ('Order', 'AdmitDiagnosis'): 'admit_diagnosis',
+    **{('RestingECGMeasurements', m): m for m in _MEASUREMENTS},
+    **{('OriginalRestingECGMeasurements', m): 'Original_' + m for m in _MEASUREMENTS},
+}
+
+def join_diagnosis_statements(statements):
     """
-    Extract relevant ECG data from a Muse XML file.
-
-    Returns a dictionary with ECG data and metadata.
+    Join DiagnosisStatement elements into a single diagnosis string.
+    Statements are separated by a space; a newline follows each ENDSLINE flag.
 
     Inputs:
-    - filename: Path to the Muse XML file.
+    - statements: Iterable of DiagnosisStatement elements.
 
     Outputs:
-    - ECG: Dictionary containing ECG data and metadata.
+    - Joined diagnosis text (unstripped).
     """
-    def get_int_or_none(path):
-        val = root.findtext(path)
+    # Collect pieces and join once; += on a str copies the whole string each time
+    parts = []
+    for diag_statement in statements:
+        # One scan over the children instead of a find() per tag
+        text = None
+        ends_line = False
+        for child in diag_statement:
+            if child.tag == 'StmtText':
+                if text is None:
+                    text = child.text
+            elif child.tag == 'StmtFlag' and child.text and child.text.strip() == 'ENDSLINE':
+                ends_line = True
+        if text:
+            parts.append(text.strip())
+            parts.append(' ')
+        if ends_line:
+            parts.append('\n')
+    return ''.join(parts)
+
+def _extract_xml_impl(filename):
+    """
+    Parse a Muse XML file into the ECG dictionary (uncached; see extract_xml).
+    """
+    def get_int_or_none(key):
+        val = fields.get(key)
         return int(val) if val is not None and val.strip().isdigit() else None
 
-    parser = etree.XMLParser()
-    tree = etree.parse(filename, parser)
-    root = tree.getroot()
+    # Hand libxml2 the whole file as one buffer instead of going through its file I/O
+    with open(filename, 'rb') as f:
+        root = etree.fromstring(f.read(), _PARSER, base_url=str(filename))
+
+    # One pass over the top-level sections; first match wins, like findtext
+    fields = {}
+    for section in root:
+        for elem in section:
+            key = _FIELD_PATHS.get((section.tag, elem.tag))
+            if key is not None and key not in fields:
+                fields[key] = elem.text or ''
 
     ECG = {
         'file_path': filename,
-        'patient_id': root.findtext('.//PatientID', default='Unknown'),
-        'patient_age': get_int_or_none('./PatientDemographics/PatientAge'),
-        'patient_gender': root.findtext('./PatientDemographics/Gender', default='Unknown'),
-        'patient_race': root.findtext('./PatientDemographics/Race', default='Unknown'),
-        'priority': root.findtext('./TestDemographics/Priority', default='Unknown'),
-        'location': root.findtext('./TestDemographics/LocationName', default='Unknown'),
-        'ecg_date': root.findtext('./TestDemographics/AcquisitionDate', default='Unknown'),
-        'acquisition_software_version': root.findtext('./TestDemographics/AcquisitionSoftwareVersion', default='Unknown'),
-        'analysis_software_version': root.findtext('./TestDemographics/AnalysisSoftwareVersion', default='Unknown'),
-        'overread_lastname': root.findtext('./TestDemographics/OverreaderLastName', default='Unknown'),
-        'overread_firstname': root.findtext('./TestDemographics/OverreaderFirstName', default='Unknown'),
-        'admit_diagnosis': root.findtext('./Order/AdmitDiagnosis', default='Unknown'),
+        'patient_id': fields.get('patient_id', 'Unknown'),
+        'patient_age': get_int_or_none('patient_age'),
+        'patient_gender': fields.get('patient_gender', 'Unknown'),
+        'patient_race': fields.get('patient_race', 'Unknown'),
+        'priority': fields.get('priority', 'Unknown'),
+        'location': fields.get('location', 'Unknown'),
+        'ecg_date': fields.get('ecg_date', 'Unknown'),
+        'acquisition_software_version': fields.get('acquisition_software_version', 'Unknown'),
+        'analysis_software_version': fields.get('analysis_software_version', 'Unknown'),
+        'overread_lastname': fields.get('overread_lastname', 'Unknown'),
+        'overread_firstname': fields.get('overread_firstname', 'Unknown'),
+        'admit_diagnosis': fields.get('admit_diagnosis', 'Unknown'),
         'diagnosis_statement': '',
         'original_diagnosis': '',
-        'VentricularRate': get_int_or_none('./RestingECGMeasurements/VentricularRate'),
-        'AtrialRate': get_int_or_none('./RestingECGMeasurements/AtrialRate'),
-        'PRInterval': get_int_or_none('./RestingECGMeasurements/PRInterval'),
-        'QRSDuration': get_int_or_none('./RestingECGMeasurements/QRSDuration'),
-        'QTInterval': get_int_or_none('./RestingECGMeasurements/QTInterval'),
-        'QTCorrected': get_int_or_none('./RestingECGMeasurements/QTCorrected'),
-        'PAxis': get_int_or_none('./RestingECGMeasurements/PAxis'),
-        'RAxis': get_int_or_none('./RestingECGMeasurements/RAxis'),
-        'TAxis': get_int_or_none('./RestingECGMeasurements/TAxis'),
-        'QRSCount': get_int_or_none('./RestingECGMeasurements/QRSCount'),
-        'Original_VentricularRate': get_int_or_none('./OriginalRestingECGMeasurements/VentricularRate'),
-        'Original_AtrialRate': get_int_or_none('./OriginalRestingECGMeasurements/AtrialRate'),
-        'Original_PRInterval': get_int_or_none('./OriginalRestingECGMeasurements/PRInterval'),
-        'Original_QRSDuration': get_int_or_none('./OriginalRestingECGMeasurements/QRSDuration'),
-        'Original_QTInterval': get_int_or_none('./OriginalRestingECGMeasurements/QTInterval'),
-        'Original_QTCorrected': get_int_or_none('./OriginalRestingECGMeasurements/QTCorrected'),
-        'Original_PAxis': get_int_or_none('./OriginalRestingECGMeasurements/PAxis'),
-        'Original_RAxis': get_int_or_none('./OriginalRestingECGMeasurements/RAxis'),
-        'Original_TAxis': get_int_or_none('./OriginalRestingECGMeasurements/TAxis'),
-        'Original_QRSCount': get_int_or_none('./OriginalRestingECGMeasurements/QRSCount'),
+        'VentricularRate': get_int_or_none('VentricularRate'),
+        'AtrialRate': get_int_or_none('AtrialRate'),
+        'PRInterval': get_int_or_none('PRInterval'),
+        'QRSDuration': get_int_or_none('QRSDuration'),
+        'QTInterval': get_int_or_none('QTInterval'),
+        'QTCorrected': get_int_or_none('QTCorrected'),
+        'PAxis': get_int_or_none('PAxis'),
+        'RAxis': get_int_or_none('RAxis'),
+        'TAxis': get_int_or_none('TAxis'),
+        'QRSCount': get_int_or_none('QRSCount'),
+        'Original_VentricularRate': get_int_or_none('Original_VentricularRate'),
+        'Original_AtrialRate': get_int_or_none('Original_AtrialRate'),
+        'Original_PRInterval': get_int_or_none('Original_PRInterval'),
+        'Original_QRSDuration': get_int_or_none('Original_QRSDuration'),
+        'Original_QTInterval': get_int_or_none('Original_QTInterval'),
+        'Original_QTCorrected': get_int_or_none('Original_QTCorrected'),
+        'Original_PAxis': get_int_or_none('Original_PAxis'),
+        'Original_RAxis': get_int_or_none('Original_RAxis'),
+        'Original_TAxis': get_int_or_none('Original_TAxis'),
+        'Original_QRSCount': get_int_or_none('Original_QRSCount'),
     }
 
-    for diag_statment in root.xpath('./Diagnosis/DiagnosisStatement'):
-        if diag_statment.tag.lower() == 'diagnosisstatement':
-            ECG['diagnosis_statement'] += diag_statment.find('StmtText').text.strip() + ' '
-            try:
-                if diag_statment.find('StmtFlag').text.strip() == 'ENDSLINE':
-                    ECG['diagnosis_statement'] += '\n'
-            except AttributeError:
-                pass
-
-    for diag_statement in root.xpath('./OriginalDiagnosis/DiagnosisStatement'):
-        if diag_statement.tag.lower() == 'diagnosisstatement':
-            ECG['original_diagnosis'] += diag_statement.find('StmtText').text.strip() + ' '
-            try:
-                if diag_statement.find('StmtFlag').text.strip() == 'ENDSLINE':
-                    ECG['original_diagnosis'] += '\n'
-            except AttributeError:
-                pass
-
+    ECG['diagnosis_statement'] = join_diagnosis_statements(_DIAG_XPATH(root))
+    ECG['original_diagnosis'] = join_diagnosis_statements(_ORIG_DIAG_XPATH(root))
 
     ECG['diagnosis_statement'] = ECG['diagnosis_statement'].strip() if ECG['diagnosis_statement'] else None
     ECG['original_diagnosis'] = ECG['original_diagnosis'].strip() if ECG['original_diagnosis'] else None
 
     return ECG
 
+@lru_cache(maxsize=2048)
+def _extract_xml_cached(filename, mtime_ns, size):
+    # mtime_ns/size only feed the cache key
+    return _extract_xml_impl(filename)
+
+def extract_xml(filename):
+    """
+    Extract relevant ECG data from a Muse XML file.
+
+    Returns a dictionary with ECG data and metadata.
+    Results are cached per (path, mtime, size), so re-reading an unchanged
+    file skips the parse; editing the file invalidates its entry.
+
+    Inputs:
+    - filename: Path to the Muse XML file.
+
+    Outputs:
+    - ECG: Dictionary containing ECG data and metadata.
+    """
+    st = os.stat(filename)
+    # Shallow copy so callers can't mutate the cached entry
+    return dict(_extract_xml_cached(filename, st.st_mtime_ns, st.st_size))
+
 FIELDNAMES = [
     "file_path",
     "patient_id",
@@ -133,12 +200,34 @@ def iter_xml_files(inputs):
     - If a path is a file: yield it if it ends with .xml
     - If a path is a directory: recursively yield *.xml
     """
+    # os.scandir instead of Path.rglob: no Path object or fnmatch per entry
     for p in inputs:
-        path = Path(p)
-        if path.is_file() and path.suffix.lower() == ".xml":
-            yield path
-        elif path.is_dir():
-            yield from path.rglob("*.xml")
+        # Normalise once per argument (./data -> data, a//b -> a/b) as Path did,
+        # so file_path values match earlier runs
+        p = str(Path(p))
+        if os.path.isfile(p):
+            if p.lower().endswith(".xml"):
+                yield p
+            continue
+
+        stack = [p]
+        while stack:
+            cur = stack.pop()
+            subdirs = []
+            try:
+                with os.scandir(cur) as it:
+                    for entry in it:
+                        # Path('.') / name is just name; keep that for the current directory
+                        path = entry.name if cur == "." else entry.path
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(path)
+                        elif entry.name.endswith(".xml") and entry.is_file():
+                            yield path
+            except OSError:
+                # Missing or unreadable directory; skip it like rglob does
+                continue
+            # Reversed so subdirectories pop in scan order (same depth-first order as rglob)
+            stack.extend(reversed(subdirs))
 
 def iter_xml_filelist(filelist):
     """
@@ -151,57 +240,128 @@ def iter_xml_filelist(filelist):
             if path:
                 yield Path(path)
 
+# CR/LF -> literal '\\n'; built once instead of on every clean_value call
+_TSV_TRANSLATE = str.maketrans({"\r": "\\n", "\n": "\\n"})
+
+# Same terminator csv.writer used, so --append onto older files stays consistent
+_TSV_LINE_END = "\r\n"
+
+def clean_value(v):
+    """
+    Normalize one value so the TSV stays one record per line.
+    Converts newlines in strings to literal '\\n'; other values pass through.
+    """
+    if isinstance(v, str):
+        # Collapse CRLF first, then map any remaining CR/LF in one C-level pass
+        return v.replace("\r\n", "\n").translate(_TSV_TRANSLATE)
+    return v
+
 def clean_row_for_tsv(row_dict):
     """
     Normalize strings so TSV stays one record per line.
     Converts newlines to literal '\\n'.
+    Returns the row as a list in FIELDNAMES order.
     """
-    cleaned = {}
-    for k in FIELDNAMES:
-        v = row_dict.get(k, None)
-        if isinstance(v, str):
-            cleaned[k] = v.replace("\r\n", "\n").replace("\r", "\n").replace("\n", "\\n")
-        else:
-            cleaned[k] = v
-    return cleaned
+    return [clean_value(row_dict.get(k)) for k in FIELDNAMES]
 
+def format_tsv_row(row_dict):
+    """
+    Format one row as a TSV line in FIELDNAMES order.
+    Output matches csv.writer(delimiter="\\t") byte for byte: None becomes an
+    empty field, and fields with a tab or quote are quoted with quotes doubled.
+    """
+    fields = []
+    for v in clean_row_for_tsv(row_dict):
+        if v is None:
+            v = ""
+        elif not isinstance(v, str):
+            v = str(v)
+        elif '"' in v or "\t" in v:
+            # Same quoting csv.writer's QUOTE_MINIMAL applied (CR/LF are already escaped)
+            v = '"' + v.replace('"', '""') + '"'
+        fields.append(v)
+    return "\t".join(fields) + _TSV_LINE_END
+
+
+def extract_xml_safe(xml_file):
+    """
+    Worker-process wrapper around extract_xml (top-level so it pickles).
+    Returns (xml_file, ecg, error) so one bad file doesn't take down the batch.
+    """
+    try:
+        return xml_file, extract_xml(xml_file), None
+    except Exception as e:
+        return xml_file, None, str(e)
 
-def write_metadata_batch(xml_paths, out_tsv, append=False, progress_every=10000):
+def write_rows(f, results, progress_every):
+    """
+    Write (xml_file, ecg, error) results from extract_xml_safe as TSV rows.
+    Returns the number of rows written.
+    """
+    n = 0
+    for xml_file, ecg, err in results:
+        if err is not None:
+            # Keep going; log failures to stderr-friendly output
+            print(f"[WARN] Failed on {xml_file}: {err}")
+            continue
+        f.write(format_tsv_row(ecg))
+        n += 1
+        if progress_every and n % progress_every == 0:
+            print(f"Processed {n:,} files... (latest: {xml_file})")
+    return n
+
+def write_metadata_batch(xml_paths, out_tsv, append=False, progress_every=10000, jobs=1):
     """
     Stream extraction results into a TSV (one row per XML).
     Opens the output file once (fast).
+    Parses files serially in input order by default; with jobs > 1, parses in
+    that many worker processes and writes rows in completion order.
     Writes header if needed.
     """
     out_tsv = Path(out_tsv)
     file_exists = out_tsv.exists()
 
     mode = "a" if append else "w"
-    with out_tsv.open(mode, newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=FIELDNAMES,
-            delimiter="\t",
-            extrasaction="ignore"
-        )
-
+    # 4 MiB buffer: rows are ~0.5 KB, so the default 8 KB buffer flushes every few rows
+    with out_tsv.open(mode, newline="", encoding="utf-8", buffering=4 * 1024 * 1024) as f:
         # Write header only if we're overwriting OR appending to a new file
         if (not append) or (append and not file_exists):
-            writer.writeheader()
+            f.write("\t".join(FIELDNAMES) + _TSV_LINE_END)
 
-        n = 0
-        for xml_file in xml_paths:
-            try:
-                ecg = extract_xml(str(xml_file))
-                writer.writerow(clean_row_for_tsv(ecg))
-                n += 1
-                if progress_every and n % progress_every == 0:
-                    print(f"Processed {n:,} files... (latest: {xml_file})")
-            except Exception as e:
-                # Keep going; log failures to stderr-friendly output
-                print(f"[WARN] Failed on {xml_file}: {e}")
+        paths = map(str, xml_paths)
+        if jobs == 1:
+            n = write_rows(f, map(extract_xml_safe, paths), progress_every)
+        else:
+            # Workers parse while this process writes finished rows, so there is one writer
+            with mp.Pool(jobs) as pool:
+                results = pool.imap_unordered(extract_xml_safe, paths, chunksize=64)
+                n = write_rows(f, results, progress_every)
 
     print(f"Done. Wrote {n:,} rows to {out_tsv}")
 
+def available_cpus():
+    """
+    Number of CPUs this process may run on.
+    Honors the affinity mask (SLURM/cgroups) where the OS exposes it,
+    otherwise falls back to os.cpu_count().
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def positive_int(value):
+    """
+    argparse type for options that must be an integer >= 1.
+    """
+    try:
+        n = int(value)
+    except ValueError:
+        n = 0
+    if n < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, got {value!r}")
+    return n
+
 def main():
     parser = argparse.ArgumentParser(
         description="Extract Muse XML metadata and export to a single TSV."
@@ -239,6 +399,13 @@ def main():
         help="Print progress every N files; use 0 to disable"
     )
 
+    parser.add_argument(
+        "--jobs",
+        type=positive_int,
+        default=available_cpus(),
+        help="Worker processes for parsing; defaults to the CPUs available to this job, use 1 to run serially"
+    )
+
     args = parser.parse_args()
 
     if args.filelist:
@@ -250,7 +417,8 @@ def main():
         xml_paths=xml_iter,
         out_tsv=args.out,
         append=args.append,
-        progress_every=args.progress_every
+        progress_every=args.progress_every,
+        jobs=args.jobs
     )
 
 if __name__ == "__main__":